@@ -7,6 +7,11 @@ import mathutils
 
 import numpy as np
 
+# The drain cylinder is centered this far below the lowest point of the mesh
+DRAIN_OFFSET = 0.025
+# The top of the castable mold box sits half of this below the boundary of the exposed faces
+CAST_TOP_DROP = 0.01
+
 
 class BIOCEMENT_PT_MainPanel(bpy.types.Panel):
     bl_label = "BioCement"
@@ -53,6 +58,12 @@ class BIOCEMENT_PT_MainPanel(bpy.types.Panel):
         else:
             layout.label(text="Vertex Sharpness: Bad", icon='ERROR')
 
+        layout.prop(context.scene, "mold_thickness")
+        layout.prop(context.scene, "mold_padding_xy")
+        layout.prop(context.scene, "mold_padding_z")
+        layout.prop(context.scene, "drain_radius")
+        layout.prop(context.scene, "drain_depth")
+        layout.operator("biocement.sweep_mold_parameters", text="Sweep Mold Parameters")
         layout.operator("biocement.create_conf_outer_mold", text="Create Conformal Outer Mold")
         layout.operator("biocement.create_cast_outer_mold", text="Create Castable Outer Mold")
         layout.operator("biocement.generate_recipe", text="Generate Recipe")
@@ -185,9 +196,9 @@ class BIOCEMENT_OT_create_conf_outer_mold(bpy.types.Operator):
         # This needs to be done before the mold is created so that the boolean modifier works correctly
         drain_point = get_drain_point(bm)
         bpy.ops.mesh.primitive_cylinder_add(
-            radius=0.05,
-            depth=0.26,
-            location=(drain_point.x, drain_point.y, drain_point.z - 0.025)
+            radius=context.scene.drain_radius,
+            depth=context.scene.drain_depth,
+            location=(drain_point.x, drain_point.y, drain_point.z - DRAIN_OFFSET)
         )
         context.active_object.name = "Drain"
         
@@ -221,7 +232,7 @@ class BIOCEMENT_OT_create_conf_outer_mold(bpy.types.Operator):
 
         # Create a Solidify modifier on the new object
         solidify_modifier = new_obj.modifiers.new(name="Solidify", type='SOLIDIFY')
-        solidify_modifier.thickness = -0.1  # Adjust the thickness as needed
+        solidify_modifier.thickness = -context.scene.mold_thickness  # Negative so the shell grows outwards
 
         # Apply the modifier to make the change permanent
         bpy.ops.object.modifier_apply(modifier=weld_modifier.name)
@@ -292,33 +303,25 @@ class BIOCEMENT_OT_create_cast_outer_mold(bpy.types.Operator):
 
         # NVM the above, it's more complicated than we need, just use an axis-aligned bounding box
 
-        # Get boundary of un-selected faces and calculate average Z
-        selected_faces = [f for f in bm.faces if not f.select]
-        if len(selected_faces) > 1:
-            boundary_face = bmesh.utils.face_join(selected_faces)
-        else:
-            boundary_face = selected_faces[0]
-        bound_z_avg = sum([v.co.z for v in boundary_face.verts]) / len(boundary_face.verts)
-
-        x_min, x_max = obj.bound_box[0][0], obj.bound_box[6][0]
-        y_min, y_max = obj.bound_box[0][1], obj.bound_box[6][1]
-        z_min, z_max = obj.bound_box[0][2], bound_z_avg
+        x_min, x_max, y_min, y_max, z_min, z_max = get_cast_bounds(obj, bm)
         
         # Create a cylinder at the lowest point of the mesh for the drain
         # This needs to be done before the cube is created so that the boolean modifier works correctly
         drain_point = get_drain_point(bm)
         bpy.ops.mesh.primitive_cylinder_add(
-            radius=0.05,
-            depth=0.26,
-            location=(drain_point.x, drain_point.y, drain_point.z - 0.025)
+            radius=context.scene.drain_radius,
+            depth=context.scene.drain_depth,
+            location=(drain_point.x, drain_point.y, drain_point.z - DRAIN_OFFSET)
         )
         context.active_object.name = "Drain"
 
         # Create a cube that bounds the object
+        padding_xy = context.scene.mold_padding_xy
+        padding_z = context.scene.mold_padding_z
         bpy.ops.mesh.primitive_cube_add(
             size=1, 
-            location=((x_min + x_max) / 2, (y_min + y_max) / 2, (z_min + z_max - 0.15) / 2), 
-            scale=(x_max - x_min + 0.3, y_max - y_min + 0.3, z_max - z_min + 0.14)
+            location=((x_min + x_max) / 2, (y_min + y_max) / 2, (z_min + z_max - padding_z - CAST_TOP_DROP) / 2), 
+            scale=(x_max - x_min + padding_xy, y_max - y_min + padding_xy, z_max - z_min + padding_z)
         )
 
         # Boolean difference to create the castable outer mold
@@ -339,6 +342,21 @@ class BIOCEMENT_OT_create_cast_outer_mold(bpy.types.Operator):
         bpy.ops.object.mode_set(mode='EDIT')
         return {'FINISHED'}
     
+def get_cast_bounds(obj, bm):
+    # Get boundary of un-selected faces and calculate average Z
+    # NOTE: This joins the un-selected faces of bm in place
+    selected_faces = [f for f in bm.faces if not f.select]
+    if len(selected_faces) > 1:
+        boundary_face = bmesh.utils.face_join(selected_faces)
+    else:
+        boundary_face = selected_faces[0]
+    bound_z_avg = sum([v.co.z for v in boundary_face.verts]) / len(boundary_face.verts)
+
+    x_min, x_max = obj.bound_box[0][0], obj.bound_box[6][0]
+    y_min, y_max = obj.bound_box[0][1], obj.bound_box[6][1]
+    z_min, z_max = obj.bound_box[0][2], bound_z_avg
+    return x_min, x_max, y_min, y_max, z_min, z_max
+
 def get_drain_point(bm):
     # Get the lowest point of the mesh
     min_z = float('inf')
@@ -394,6 +412,269 @@ def calc_volume(bm):
         volume += np.dot(verts[0], np.cross(verts[1], verts[2]))
     return np.abs(volume / 6)
 
+class BIOCEMENT_OT_sweep_mold_parameters(bpy.types.Operator):
+    """Sweep Mold Parameters. Estimates mold material, cavity volume and minimum wall thickness for every combination and applies the cheapest valid one."""
+    bl_idname = "biocement.sweep_mold_parameters"
+    bl_label = "Sweep Mold Parameters"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    mold_type: bpy.props.EnumProperty(
+        name="Mold Type",
+        items=[
+            ("CAST", "Castable", "Box mold, select the faces that will be exposed to air"),
+            ("CONFORMAL", "Conformal", "Shell mold, select all faces except the ones exposed to air"),
+        ],
+        default="CAST"
+    )
+    thickness_range: bpy.props.FloatVectorProperty(name="Thickness (min, max)", size=2, default=(0.05, 0.2), min=0.0)
+    padding_xy_range: bpy.props.FloatVectorProperty(name="Padding XY (min, max)", size=2, default=(0.1, 0.5), min=0.0)
+    padding_z_range: bpy.props.FloatVectorProperty(name="Padding Z (min, max)", size=2, default=(0.05, 0.3), min=0.0)
+    drain_radius_range: bpy.props.FloatVectorProperty(name="Drain Radius (min, max)", size=2, default=(0.02, 0.08), min=0.0)
+    drain_depth_range: bpy.props.FloatVectorProperty(name="Drain Depth (min, max)", size=2, default=(0.1, 0.4), min=0.0)
+    steps: bpy.props.IntProperty(name="Steps", description="Number of values tried per parameter", default=5, min=1, max=20)
+    min_wall_thickness: bpy.props.FloatProperty(name="Min Wall Thickness", default=0.05, min=0.0)
+    min_drain_radius: bpy.props.FloatProperty(name="Min Drain Radius", description="Narrowest drain that still drains reliably", default=0.05, min=0.0)
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
+
+    def execute(self, context):
+        obj = context.active_object
+        if obj is None or obj.type != 'MESH':
+            self.report({'WARNING'}, "No active mesh object")
+            return {'CANCELLED'}
+
+        bpy.ops.object.mode_set(mode='OBJECT')
+        if self.mold_type == 'CAST':
+            # The castable mold works from obj.bound_box, so match the frame the cast operator uses
+            bpy.ops.object.transform_apply(location=True, scale=True)
+
+        mesh = obj.data
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
+
+        # Everything that depends on the mesh is computed once here, the sweep itself is pure arithmetic
+        verts, tris, selected, normals = get_mesh_arrays(bm)
+        drain_point = get_drain_point(bm)
+        drain_heights = get_drain_heights(obj, drain_point, np.linspace(*self.drain_radius_range, self.steps))
+        if self.mold_type == 'CAST':
+            if selected.all():
+                self.report({'WARNING'}, "Select the faces that will be exposed to air")
+                bm.free()
+                bpy.ops.object.mode_set(mode='EDIT')
+                return {'CANCELLED'}
+            x_min, x_max, y_min, y_max, z_min, z_max = get_cast_bounds(obj, bm)
+            results = sweep_cast_mold(
+                (x_max - x_min, y_max - y_min, z_max - z_min),
+                calc_volume_below(verts, tris, z_max - CAST_TOP_DROP / 2),
+                drain_heights,
+                self.padding_xy_range, self.padding_z_range,
+                self.drain_radius_range, self.drain_depth_range,
+                self.steps, self.min_wall_thickness, self.min_drain_radius
+            )
+        else:
+            if not selected.any():
+                self.report({'WARNING'}, "Select all faces except the faces that will be exposed to air")
+                bm.free()
+                bpy.ops.object.mode_set(mode='EDIT')
+                return {'CANCELLED'}
+            results = sweep_conformal_mold(
+                calc_shell_coefficients(verts, tris[selected], normals),
+                calc_volume_below(verts, tris, np.inf),
+                drain_heights,
+                self.thickness_range,
+                self.drain_radius_range, self.drain_depth_range,
+                self.steps, self.min_wall_thickness, self.min_drain_radius
+            )
+        bm.free()
+
+        # Write the table to a text block so it can be inspected in the Text Editor
+        names = list(results.keys())
+        order = rank_mold_configurations(results)
+        rows = ["\t".join(names)]
+        rows += ["\t".join(f"{results[name][i]:.4f}" for name in names) for i in order]
+        text = bpy.data.texts.get("MoldSweep") or bpy.data.texts.new("MoldSweep")
+        text.clear()
+        text.write("\n".join(rows) + "\n")
+
+        bpy.ops.object.mode_set(mode='EDIT')
+        valid = order[results["valid"][order]]
+        if len(valid) == 0:
+            self.report({'WARNING'}, "No valid mold configuration, see the MoldSweep text block")
+            return {'CANCELLED'}
+
+        # Apply the cheapest valid configuration so the create mold operators use it
+        best = valid[0]
+        for name in ("mold_thickness", "mold_padding_xy", "mold_padding_z", "drain_radius", "drain_depth"):
+            if name in results:
+                setattr(context.scene, name, results[name][best])
+        self.report({'INFO'}, f"Cheapest valid mold: {results['material_volume'][best]:.3f} L of material "
+                              f"({len(valid)} of {len(order)} configurations valid)")
+        return {'FINISHED'}
+
+def get_mesh_arrays(bm):
+    # Triangles of the mesh as numpy arrays, bm itself is left untouched
+    bm.verts.index_update()
+    loop_triangles = bm.calc_loop_triangles()
+    verts = np.array([v.co for v in bm.verts], dtype=float).reshape(-1, 3)
+    tris = np.array([[loop.vert.index for loop in lt] for lt in loop_triangles], dtype=int).reshape(-1, 3)
+    selected = np.array([lt[0].face.select for lt in loop_triangles], dtype=bool)
+
+    # Vertex normals of the welded copy of the selected faces the Solidify modifier works on.
+    # Like Blender's own vertex normals they weight each face normal by its corner angle.
+    normals = np.zeros_like(verts)
+    for face in bm.faces:
+        if face.select:
+            for loop in face.loops:
+                normals[loop.vert.index] += np.array(face.normal) * loop.calc_angle()
+    lengths = np.linalg.norm(normals, axis=1)
+    normals[lengths > 0] /= lengths[lengths > 0, None]
+    return verts, tris, selected, normals
+
+def get_drain_heights(obj, drain_point, drain_radii, samples=64):
+    # Height of the bottom of the mesh above the drain point, sampled evenly over the cross-section of the
+    # drain for each radius. NaN where the drain misses the mesh.
+    i = np.arange(samples) + 0.5
+    rho = np.sqrt(i / samples)
+    theta = i * np.pi * (3 - np.sqrt(5))
+    heights = np.full((len(drain_radii), samples), np.nan)
+    for j, radius in enumerate(drain_radii):
+        for k in range(samples):
+            origin = mathutils.Vector((
+                drain_point.x + radius * rho[k] * np.cos(theta[k]),
+                drain_point.y + radius * rho[k] * np.sin(theta[k]),
+                drain_point.z - 1
+            ))
+            # Cast a ray upwards from below the mesh, the first hit is the bottom of the cavity
+            result, location, normal, index = obj.ray_cast(origin, mathutils.Vector((0, 0, 1)))
+            if result:
+                heights[j, k] = location.z - drain_point.z
+    return heights
+
+def rank_mold_configurations(results):
+    # Valid configurations first, then by material without the drain hole so a bigger drain never
+    # looks cheaper, then the narrowest and shortest drain. np.lexsort is stable and sorts by the last key first.
+    mold_volume = results["material_volume"] + results["drain_volume"]
+    return np.lexsort((results["drain_depth"], results["drain_radius"], mold_volume, ~results["valid"]))
+
+def calc_volume_below(verts, tris, z_cut):
+    # Volume of the closed mesh below the plane z = z_cut
+    # By the divergence theorem V = sum of integral (z - z_cut) * n_z dA over the surface, and the cut cap
+    # contributes nothing since z = z_cut there. Per triangle this is the integral of min(z - z_cut, 0)
+    # over its projection on the XY plane, which has a closed form for a linear function.
+    v = verts[tris]
+    area = 0.5 * np.cross(v[:, 1] - v[:, 0], v[:, 2] - v[:, 0])[:, 2]
+    z_cut = min(z_cut, v[:, :, 2].max())
+    f1, f2, f3 = np.sort(v[:, :, 2] - z_cut, axis=1).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        one_below = f1 ** 3 / (3 * (f2 - f1) * (f3 - f1))
+        two_below = (f1 + f2 + f3) / 3 - f3 ** 3 / (3 * (f3 - f1) * (f3 - f2))
+    integral = np.where(f3 <= 0, (f1 + f2 + f3) / 3,
+               np.where(f1 >= 0, 0.0,
+               np.where(f2 >= 0, one_below, two_below)))
+    return np.abs(np.sum(area * integral))
+
+def calc_shell_coefficients(verts, tris, normals):
+    # The Solidify modifier offsets every vertex along its normal, so the shell volume is the sum of the
+    # ruled prisms between each triangle and its offset copy. That is a cubic in the thickness t:
+    # V(t) = c1 * t + c2 * t^2 + c3 * t^3
+    v = verts[tris]
+    n = normals[tris]
+    e1, e2 = v[:, 1] - v[:, 0], v[:, 2] - v[:, 0]
+    d1, d2 = n[:, 1] - n[:, 0], n[:, 2] - n[:, 0]
+    n_avg = n.mean(axis=1)
+    c1 = np.sum(np.cross(e1, e2) * n_avg) / 2
+    c2 = np.sum((np.cross(e1, d2) + np.cross(d1, e2)) * n_avg) / 4
+    c3 = np.sum(np.cross(d1, d2) * n_avg) / 6
+
+    # Measured square to a face, the wall at each of its corners is only t * dot(n_vertex, n_face) thick
+    face_normals = np.cross(e1, e2)
+    lengths = np.linalg.norm(face_normals, axis=1)
+    face_normals = face_normals[lengths > 0] / lengths[lengths > 0, None]
+    wall_factor = np.einsum('ijk,ik->ij', n[lengths > 0], face_normals).min()
+    return c1, c2, c3, wall_factor
+
+def calc_drain_volume(drain_radius, drain_depth, material_bottom, material_top):
+    # Volume the drain cylinder removes from the mold. material_bottom and material_top give the span of
+    # mold material above each sample point of the drain cross-section (last axis), relative to the lowest
+    # point of the mesh. NaN spans hold no material.
+    drain_bottom = np.asarray(-DRAIN_OFFSET - drain_depth / 2)[..., None]
+    drain_top = np.asarray(-DRAIN_OFFSET + drain_depth / 2)[..., None]
+    overlap = np.clip(np.minimum(drain_top, material_top) - np.maximum(drain_bottom, material_bottom), 0, None)
+    return np.pi * drain_radius ** 2 * np.nan_to_num(overlap).mean(axis=-1)
+
+def sweep_cast_mold(dimensions, cavity_volume, drain_heights, padding_xy_range, padding_z_range,
+                    drain_radius_range, drain_depth_range, steps=5, min_wall_thickness=0.05, min_drain_radius=0.05):
+    # drain_heights comes from get_drain_heights for the same drain radii the sweep tries
+    padding_xy_values = np.linspace(*padding_xy_range, steps)
+    padding_z_values = np.linspace(*padding_z_range, steps)
+    drain_radius_values = np.linspace(*drain_radius_range, steps)
+    drain_depth_values = np.linspace(*drain_depth_range, steps)
+    padding_xy, padding_z, drain_radius, drain_depth = [a.ravel() for a in np.meshgrid(
+        padding_xy_values, padding_z_values, drain_radius_values, drain_depth_values, indexing='ij'
+    )]
+    dx, dy, dz = dimensions
+    box_volume = (dx + padding_xy) * (dy + padding_xy) * (dz + padding_z)
+    # The box bottom sits below the lowest point by the Z padding plus whatever the top was dropped by
+    floor = padding_z + CAST_TOP_DROP / 2
+    min_wall = np.minimum(padding_xy / 2, floor)
+    # The box is solid from its bottom up to the cavity, or all the way up where the drain misses the mesh.
+    # The drain only depends on the Z padding, radius and depth, so it is computed on that smaller grid.
+    material_top = np.where(np.isnan(drain_heights), np.inf, drain_heights)
+    drain_volume = calc_drain_volume(
+        drain_radius_values[None, :, None],
+        drain_depth_values[None, None, :],
+        -(padding_z_values + CAST_TOP_DROP / 2)[:, None, None, None],
+        material_top[None, :, None, :]
+    )
+    drain_volume = np.broadcast_to(drain_volume, (steps,) * 4).ravel()
+    material_volume = box_volume - cavity_volume - drain_volume
+    # The drain has to go through the floor and reach into the cavity
+    drain_open = (-DRAIN_OFFSET - drain_depth / 2 < -floor) & (-DRAIN_OFFSET + drain_depth / 2 > 0) & (drain_radius >= min_drain_radius) & (drain_radius > 0)
+    return {
+        "mold_padding_xy": padding_xy,
+        "mold_padding_z": padding_z,
+        "drain_radius": drain_radius,
+        "drain_depth": drain_depth,
+        "material_volume": material_volume,
+        "drain_volume": drain_volume,
+        "cavity_volume": np.full_like(material_volume, cavity_volume),
+        "min_wall_thickness": min_wall,
+        "valid": drain_open & (min_wall >= min_wall_thickness),
+    }
+
+def sweep_conformal_mold(shell_coefficients, cavity_volume, drain_heights, thickness_range,
+                         drain_radius_range, drain_depth_range, steps=5, min_wall_thickness=0.05, min_drain_radius=0.05):
+    # drain_heights comes from get_drain_heights for the same drain radii the sweep tries
+    thickness_values = np.linspace(*thickness_range, steps)
+    drain_radius_values = np.linspace(*drain_radius_range, steps)
+    drain_depth_values = np.linspace(*drain_depth_range, steps)
+    thickness, drain_radius, drain_depth = [a.ravel() for a in np.meshgrid(
+        thickness_values, drain_radius_values, drain_depth_values, indexing='ij'
+    )]
+    c1, c2, c3, wall_factor = shell_coefficients
+    shell_volume = np.abs(c1 * thickness + c2 * thickness ** 2 + c3 * thickness ** 3)
+    min_wall = wall_factor * thickness
+    # The shell hangs below the bottom of the cavity, taking the vertical thickness as t
+    drain_volume = calc_drain_volume(
+        drain_radius_values[None, :, None],
+        drain_depth_values[None, None, :],
+        drain_heights[None, :, None, :] - thickness_values[:, None, None, None],
+        drain_heights[None, :, None, :]
+    ).ravel()
+    material_volume = shell_volume - drain_volume
+    drain_open = (-DRAIN_OFFSET - drain_depth / 2 < -thickness) & (-DRAIN_OFFSET + drain_depth / 2 > 0) & (drain_radius >= min_drain_radius) & (drain_radius > 0)
+    return {
+        "mold_thickness": thickness,
+        "drain_radius": drain_radius,
+        "drain_depth": drain_depth,
+        "material_volume": material_volume,
+        "drain_volume": drain_volume,
+        "cavity_volume": np.full_like(material_volume, cavity_volume),
+        "min_wall_thickness": min_wall,
+        "valid": drain_open & (min_wall >= min_wall_thickness),
+    }
+
 def register():
     # # Populate the dropdown menus
     # bpy.types.Scene.my_dropdown_menu_1 = bpy.props.EnumProperty(
@@ -442,6 +723,41 @@ def register():
         default=0.0
     )
 
+    bpy.types.Scene.mold_thickness = bpy.props.FloatProperty(
+        name="Mold Thickness",
+        description="Wall thickness of the conformal outer mold",
+        default=0.1,
+        min=0.0
+    )
+
+    bpy.types.Scene.mold_padding_xy = bpy.props.FloatProperty(
+        name="Mold Padding XY",
+        description="Total padding added to the width and depth of the castable outer mold",
+        default=0.3,
+        min=0.0
+    )
+
+    bpy.types.Scene.mold_padding_z = bpy.props.FloatProperty(
+        name="Mold Padding Z",
+        description="Padding added to the height of the castable outer mold",
+        default=0.14,
+        min=0.0
+    )
+
+    bpy.types.Scene.drain_radius = bpy.props.FloatProperty(
+        name="Drain Radius",
+        description="Radius of the drain hole",
+        default=0.05,
+        min=0.0
+    )
+
+    bpy.types.Scene.drain_depth = bpy.props.FloatProperty(
+        name="Drain Depth",
+        description="Length of the drain hole cylinder",
+        default=0.26,
+        min=0.0
+    )
+
     bpy.types.Scene.mesh_thickness = bpy.props.BoolProperty(
         name="Mesh Thickness",
         description="Whether the geometry meets the thickness requirement",
@@ -470,6 +786,7 @@ def register():
     bpy.utils.register_class(BIOCEMENT_OT_create_conf_outer_mold)
     bpy.utils.register_class(BIOCEMENT_OT_create_cast_outer_mold)
     bpy.utils.register_class(BIOCEMENT_OT_generate_recipe)
+    bpy.utils.register_class(BIOCEMENT_OT_sweep_mold_parameters)
     bpy.utils.register_class(BIOCEMENT_PT_MainPanel)
 
 def unregister():
@@ -477,6 +794,7 @@ def unregister():
     bpy.utils.unregister_class(BIOCEMENT_OT_create_conf_outer_mold)
     bpy.utils.unregister_class(BIOCEMENT_OT_create_cast_outer_mold)
     bpy.utils.unregister_class(BIOCEMENT_OT_generate_recipe)
+    bpy.utils.unregister_class(BIOCEMENT_OT_sweep_mold_parameters)
     bpy.utils.unregister_class(BIOCEMENT_PT_MainPanel)
     del bpy.types.Scene.my_dropdown_menu_1
     del bpy.types.Scene.my_dropdown_menu_2